@@ -25,6 +25,8 @@ const T = {
 
 const fmt = n => n >= 1e6 ? (n/1e6).toFixed(1)+'M' : n >= 1000 ? (n/1000).toFixed(1)+'k' : String(n||0);
 const pct = n => `${(n*100).toFixed(1)}%`;
+const fromColumns = c => {const ks=Object.keys(c||{});const n=ks.length?c[ks[0]].length:0;return Array.from({length:n},(_,i)=>Object.fromEntries(ks.map(k=>[k,c[k][i]])));};
+const fromTable = d => (d.rows||[]).map(r=>Object.fromEntries(d.columns.map((c,i)=>[c,r[i]])));
 const timeAgo = ts => {
   const d=(Date.now()-new Date(ts))/1000;
   if(d<60) return `${Math.floor(d)}s`;
@@ -194,10 +196,10 @@ function Toast({ msg, type }) {
 function DashboardPage({ data }) {
   if(!data) return <div style={{display:'flex',flexDirection:'column',alignItems:'center',justifyContent:'center',height:400,gap:16}}><div style={{width:32,height:32,border:`3px solid ${T.blue}`,borderTopColor:'transparent',borderRadius:'50%',animation:'spin 0.8s linear infinite'}}/><span style={{color:T.textMuted,fontSize:12}}>Chargement...</span></div>;
   const k=data.kpis||{};
-  const timeline=(data.timeline||[]).map(r=>({t:new Date(r.hour).toLocaleTimeString('fr',{hour:'2-digit',minute:'2-digit'}),total:r.total,blocked:r.blocked,suspicious:r.suspicious}));
-  const owaspData=(data.top_owasp||[]).map(r=>({name:r.owasp_category,v:r.count}));
-  const attackDist=data.attack_distribution||[];
-  const topIps=(data.top_ips||[]).slice(0,8);
+  const timeline=fromColumns(data.timeline).map(r=>({t:new Date(r.hour).toLocaleTimeString('fr',{hour:'2-digit',minute:'2-digit'}),total:r.total,blocked:r.blocked,suspicious:r.suspicious}));
+  const owaspData=fromColumns(data.top_owasp).map(r=>({name:r.owasp_category,v:r.count}));
+  const attackDist=fromColumns(data.attack_distribution);
+  const topIps=fromColumns(data.top_ips).slice(0,8);
   return (
     <div style={{display:'flex',flexDirection:'column',gap:20}}>
       <div style={{display:'grid',gridTemplateColumns:'repeat(6,1fr)',gap:12}}>
@@ -487,7 +489,7 @@ export default function App() {
 
   const showToast=useCallback((msg,type='ok')=>{setToast({msg,type});setTimeout(()=>setToast(null),4000);},[]);
   const loadDashboard=useCallback(async()=>{const d=await api('/api/dashboard/stats');if(!d.error){setDashboard(d);const k=d.kpis||{};const r=k.avg_risk_score||0;setThreatLevel(r>0.8?'CRITIQUE':r>0.6?'ÉLEVÉ':r>0.3?'MODÉRÉ':'FAIBLE');}},[]);
-  const loadLive=useCallback(async()=>{const d=await api('/api/dashboard/live?limit=50');if(!d.error)setLiveData(d.requests||[]);},[]);
+  const loadLive=useCallback(async()=>{const d=await api('/api/dashboard/live?limit=50');if(!d.error)setLiveData(fromTable(d));},[]);
 
   useEffect(()=>{loadDashboard();loadLive();},[]);
   useEffect(()=>{if(!live){clearInterval(tickRef.current);return;}tickRef.current=setInterval(()=>{loadDashboard();loadLive();},5000);return()=>clearInterval(tickRef.current);},[live,loadDashboard,loadLive]);
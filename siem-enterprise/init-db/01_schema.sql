@@ -8,9 +8,10 @@ CREATE EXTENSION IF NOT EXISTS "pg_trgm";  -- Pour recherche texte
 CREATE EXTENSION IF NOT EXISTS "btree_gin"; -- Pour index optimisés
 
 -- ─── TABLE 1: raw_requests (Logs WAF bruts) ────────────────────────────────
+-- Partitionnée par jour ; les partitions sont créées à l'avance par le service d'ingestion
 CREATE TABLE IF NOT EXISTS raw_requests (
-    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     
     -- Requête HTTP
     method VARCHAR(10) NOT NULL,
@@ -20,7 +21,7 @@ CREATE TABLE IF NOT EXISTS raw_requests (
     headers JSONB,
     body TEXT,
     user_agent TEXT,
-    content_type VARCHAR(100),
+    content_type VARCHAR(100) GENERATED ALWAYS AS (LEFT(headers->>'content-type', 100)) STORED,
     content_length INTEGER,
     
     -- Client
@@ -44,18 +45,31 @@ CREATE TABLE IF NOT EXISTS raw_requests (
     waf_rules_triggered TEXT[],
     
     -- Stockage Data Lake
-    minio_object_key VARCHAR(500)
-);
+    minio_object_key VARCHAR(500),
+
+    -- Horloge d'insertion (UTC naïf) : clé du watermark ip_reputation, indépendante
+    -- de l'heure de l'événement fournie par le WAF
+    ingested_at TIMESTAMP DEFAULT (clock_timestamp() AT TIME ZONE 'UTC'),
+
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS raw_requests_default PARTITION OF raw_requests DEFAULT;
 
 CREATE INDEX idx_raw_requests_timestamp ON raw_requests(timestamp DESC);
 CREATE INDEX idx_raw_requests_client_ip ON raw_requests(client_ip);
 CREATE INDEX idx_raw_requests_blocked ON raw_requests(is_blocked) WHERE is_blocked = true;
 CREATE INDEX idx_raw_requests_url_gin ON raw_requests USING gin(url gin_trgm_ops);
+CREATE INDEX idx_raw_requests_ts_brin ON raw_requests USING brin(timestamp) WITH (pages_per_range = 32);
+CREATE INDEX idx_raw_requests_client_ip_ts ON raw_requests(client_ip, timestamp DESC) INCLUDE (path, method, status_code);
+CREATE INDEX idx_raw_requests_headers_gin ON raw_requests USING gin(headers jsonb_path_ops);
+CREATE INDEX idx_raw_requests_ctype ON raw_requests((headers->>'content-type'));
+CREATE INDEX idx_raw_requests_ingested_brin ON raw_requests USING brin(ingested_at) WITH (pages_per_range = 32);
 
 -- ─── TABLE 2: owasp_detections (Détections OWASP) ──────────────────────────
 CREATE TABLE IF NOT EXISTS owasp_detections (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-    request_id UUID REFERENCES raw_requests(id) ON DELETE CASCADE,
+    request_id UUID,  -- raw_requests(id) ; pas de FK vers une table partitionnée
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     -- Classification OWASP
@@ -73,11 +87,12 @@ CREATE TABLE IF NOT EXISTS owasp_detections (
 CREATE INDEX idx_owasp_timestamp ON owasp_detections(timestamp DESC);
 CREATE INDEX idx_owasp_category ON owasp_detections(owasp_category);
 CREATE INDEX idx_owasp_request ON owasp_detections(request_id);
+CREATE INDEX idx_owasp_ts_brin ON owasp_detections USING brin(timestamp) WITH (pages_per_range = 32);
 
 -- ─── TABLE 3: features (Features ML) ───────────────────────────────────────
 CREATE TABLE IF NOT EXISTS features (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-    request_id UUID REFERENCES raw_requests(id) ON DELETE CASCADE,
+    request_id UUID,  -- raw_requests(id) ; pas de FK vers une table partitionnée
     computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     -- Features temporelles
@@ -112,8 +127,8 @@ CREATE TABLE IF NOT EXISTS features (
     day_of_week INTEGER,
     is_business_hours BOOLEAN,
     
-    -- Vector complet (pour ML)
-    feature_vector FLOAT[]
+    -- Vector complet (pour ML) — float4 : précision suffisante, moitié moins large
+    feature_vector REAL[]
 );
 
 CREATE INDEX idx_features_request ON features(request_id);
@@ -122,7 +137,7 @@ CREATE INDEX idx_features_timestamp ON features(computed_at DESC);
 -- ─── TABLE 4: ml_predictions (Prédictions ML) ──────────────────────────────
 CREATE TABLE IF NOT EXISTS ml_predictions (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-    request_id UUID REFERENCES raw_requests(id) ON DELETE CASCADE,
+    request_id UUID,  -- raw_requests(id) ; pas de FK vers une table partitionnée
     predicted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     -- Anomaly Detection
@@ -143,14 +158,16 @@ CREATE TABLE IF NOT EXISTS ml_predictions (
     top_features JSONB  -- {"feature_name": importance_score}
 );
 
-CREATE INDEX idx_ml_predictions_request ON ml_predictions(request_id);
+-- (request_id, predicted_at DESC) : dernière prédiction d'une requête sans tri
+CREATE INDEX idx_ml_predictions_request ON ml_predictions(request_id, predicted_at DESC);
 CREATE INDEX idx_ml_predictions_anomaly ON ml_predictions(is_anomaly) WHERE is_anomaly = true;
 CREATE INDEX idx_ml_predictions_timestamp ON ml_predictions(predicted_at DESC);
+CREATE INDEX idx_ml_predictions_ts_brin ON ml_predictions USING brin(predicted_at) WITH (pages_per_range = 32);
 
 -- ─── TABLE 5: risk_assessments (Évaluations de risque) ─────────────────────
 CREATE TABLE IF NOT EXISTS risk_assessments (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-    request_id UUID REFERENCES raw_requests(id) ON DELETE CASCADE,
+    request_id UUID,  -- raw_requests(id) ; pas de FK vers une table partitionnée
     assessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     -- Score de risque global
@@ -175,6 +192,7 @@ CREATE TABLE IF NOT EXISTS risk_assessments (
 CREATE INDEX idx_risk_assessments_request ON risk_assessments(request_id);
 CREATE INDEX idx_risk_assessments_level ON risk_assessments(risk_level);
 CREATE INDEX idx_risk_assessments_timestamp ON risk_assessments(assessed_at DESC);
+CREATE INDEX idx_risk_assessments_ts_brin ON risk_assessments USING brin(assessed_at) WITH (pages_per_range = 32);
 
 -- ─── TABLE 6: soar_actions (Actions SOAR exécutées) ────────────────────────
 CREATE TABLE IF NOT EXISTS soar_actions (
@@ -247,6 +265,10 @@ CREATE INDEX idx_incidents_status ON incidents(status);
 CREATE INDEX idx_incidents_severity ON incidents(severity);
 CREATE INDEX idx_incidents_created ON incidents(created_at DESC);
 CREATE INDEX idx_incidents_source_ip ON incidents(source_ip);
+CREATE INDEX idx_incidents_ts_brin ON incidents USING brin(created_at) WITH (pages_per_range = 32);
+CREATE INDEX idx_incidents_status_created ON incidents(status, created_at DESC);
+CREATE INDEX idx_incidents_open ON incidents(created_at DESC)
+    INCLUDE (id, severity, incident_type) WHERE status IN ('OPEN', 'INVESTIGATING');
 
 -- ─── TABLE 8: security_plans (Plans de sécurité générés) ───────────────────
 CREATE TABLE IF NOT EXISTS security_plans (
@@ -340,6 +362,7 @@ CREATE TABLE IF NOT EXISTS ml_models (
 );
 
 CREATE INDEX idx_ml_models_active ON ml_models(is_active) WHERE is_active = true;
+CREATE INDEX idx_ml_models_active_created ON ml_models(created_at DESC) WHERE is_active = true;
 CREATE INDEX idx_ml_models_type ON ml_models(model_type, is_active);
 
 -- ─── TABLE 11: system_config (Configuration système) ───────────────────────
@@ -388,26 +411,21 @@ SELECT
     (SELECT AVG(risk_score) FROM risk_assessments WHERE assessed_at >= NOW() - INTERVAL '24 hours') as avg_risk_score,
     (SELECT COUNT(*) FROM ml_predictions WHERE is_anomaly = true AND predicted_at >= NOW() - INTERVAL '24 hours') as anomalies_24h;
 
--- ─── Fonction: update_ip_reputation ─────────────────────────────────────────
-CREATE OR REPLACE FUNCTION update_ip_reputation()
-RETURNS TRIGGER AS $$
-BEGIN
-    INSERT INTO ip_reputation (ip_address, last_seen, total_requests)
-    VALUES (NEW.client_ip, NEW.timestamp, 1)
-    ON CONFLICT (ip_address) DO UPDATE
-    SET
-        last_seen = NEW.timestamp,
-        total_requests = ip_reputation.total_requests + 1,
-        blocked_requests = ip_reputation.blocked_requests + (CASE WHEN NEW.is_blocked THEN 1 ELSE 0 END),
-        suspicious_requests = ip_reputation.suspicious_requests + (CASE WHEN NEW.is_suspicious THEN 1 ELSE 0 END);
-    RETURN NEW;
-END;
-$$ LANGUAGE plpgsql;
-
-CREATE TRIGGER trigger_update_ip_reputation
-AFTER INSERT ON raw_requests
-FOR EACH ROW
-EXECUTE FUNCTION update_ip_reputation();
+-- ─── ip_reputation : agrégation par lots ────────────────────────────────────
+-- Compteurs incrémentés par le risk-engine (ip_reputation_loop) par fenêtre de
+-- raw_requests.ingested_at, plutôt que par un trigger ligne à ligne sur raw_requests
+CREATE TABLE IF NOT EXISTS ip_reputation_watermark (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    aggregated_until TIMESTAMP NOT NULL
+);
+INSERT INTO ip_reputation_watermark (aggregated_until) VALUES (NOW() AT TIME ZONE 'UTC');
+
+-- Version du schéma appliquée par chaque service (ensure_tables exécuté une fois par version)
+CREATE TABLE IF NOT EXISTS siem_migrations (
+    service TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    applied_at TIMESTAMPTZ DEFAULT NOW()
+);
 
 -- ═══════════════════════════════════════════════════════════════════════════
 -- Initialisation données de base
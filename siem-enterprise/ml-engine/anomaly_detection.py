@@ -2,16 +2,29 @@
 ML Engine — Anomaly Detection Models
 Isolation Forest + One-Class SVM
 """
+import asyncio
 import numpy as np
 from sklearn.ensemble import IsolationForest
-from sklearn.svm import OneClassSVM
+from sklearn.linear_model import SGDOneClassSVM
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 import joblib
 import os
+import pickle
 from typing import Dict, List, Tuple
 from datetime import datetime
 
+# Inférence IsolationForest compilée en ONNX si disponible, sinon sklearn
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
 MODEL_DIR = "/app/models"
 os.makedirs(MODEL_DIR, exist_ok=True)
 
@@ -22,8 +35,50 @@ class AnomalyDetector:
         self.isolation_forest = None
         self.one_class_svm = None
         self.scaler = StandardScaler()
+        self._mean = None
+        self._inv_scale = None
+        self._iso_session = None
         self.is_trained = False
         self.version = None
+    
+    def _cache_scaler(self):
+        """Copie float32 de mean_ et 1/scale_ pour normaliser sans passer par transform()"""
+        self._mean = self.scaler.mean_.astype(np.float32)
+        self._inv_scale = (1.0 / self.scaler.scale_).astype(np.float32)
+    
+    def _scale(self, X: np.ndarray) -> np.ndarray:
+        """(X - mean) * 1/scale dans un seul buffer float32, sans validation sklearn"""
+        X = np.asarray(X)
+        X_scaled = np.empty(X.shape, dtype=np.float32)
+        np.subtract(X, self._mean, out=X_scaled)
+        np.multiply(X_scaled, self._inv_scale, out=X_scaled)
+        return X_scaled
+    
+    def _compile_isolation_forest(self):
+        """Convertit la forêt en graphe ONNX (arbres évalués en noyaux vectorisés)"""
+        self._iso_session = None
+        if not ONNX_AVAILABLE:
+            return
+        try:
+            onx = convert_sklearn(
+                self.isolation_forest,
+                initial_types=[("X", FloatTensorType([None, self.isolation_forest.n_features_in_]))],
+                target_opset={"": 15, "ai.onnx.ml": 3}
+            )
+            providers = [
+                p for p in ("CUDAExecutionProvider", "CPUExecutionProvider")
+                if p in ort.get_available_providers()
+            ]
+            self._iso_session = ort.InferenceSession(onx.SerializeToString(), providers=providers)
+        except Exception as e:
+            print(f"[ANOMALY] ONNX conversion unavailable, using sklearn: {e}")
+    
+    def _iso_decision(self, X_scaled: np.ndarray) -> np.ndarray:
+        if self._iso_session is not None:
+            # Sorties du convertisseur : (label, scores) — scores = decision_function
+            _, scores = self._iso_session.run(None, {"X": X_scaled})
+            return scores.ravel()
+        return self.isolation_forest.decision_function(X_scaled)
         
     def train(
         self,
@@ -44,7 +99,9 @@ class AnomalyDetector:
         print(f"[ANOMALY] Training on {X.shape[0]} samples, {X.shape[1]} features")
         
         # Normaliser features
-        X_scaled = self.scaler.fit_transform(X)
+        self.scaler.fit(X)
+        self._cache_scaler()
+        X_scaled = self._scale(X)
         
         # 1. Isolation Forest
         self.isolation_forest = IsolationForest(
@@ -55,12 +112,21 @@ class AnomalyDetector:
             n_jobs=-1
         )
         self.isolation_forest.fit(X_scaled)
+        self._compile_isolation_forest()
         
-        # 2. One-Class SVM
-        self.one_class_svm = OneClassSVM(
-            kernel='rbf',
-            gamma='auto',
-            nu=contamination  # nu ≈ contamination attendue
+        # 2. One-Class SVM linéaire sur approximation de Nyström du noyau RBF
+        #    (coût en O(n_components·d) par sample au lieu de O(n_sv·d))
+        self.one_class_svm = make_pipeline(
+            Nystroem(
+                kernel='rbf',
+                gamma=1.0 / X.shape[1],  # équivalent de gamma='auto'
+                n_components=min(100, X.shape[0]),
+                random_state=random_state
+            ),
+            SGDOneClassSVM(
+                nu=contamination,  # nu ≈ contamination attendue
+                random_state=random_state
+            )
         )
         self.one_class_svm.fit(X_scaled)
         
@@ -68,13 +134,11 @@ class AnomalyDetector:
         self.version = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         
         # Évaluer sur training data
-        iso_scores = self.isolation_forest.decision_function(X_scaled)
-        iso_preds = self.isolation_forest.predict(X_scaled)
-        iso_anomalies = (iso_preds == -1).sum()
+        iso_scores = self._iso_decision(X_scaled)
+        iso_anomalies = (iso_scores < 0).sum()
         
         svm_scores = self.one_class_svm.decision_function(X_scaled)
-        svm_preds = self.one_class_svm.predict(X_scaled)
-        svm_anomalies = (svm_preds == -1).sum()
+        svm_anomalies = (svm_scores < 0).sum()
         
         metrics = {
             "version": self.version,
@@ -106,20 +170,20 @@ class AnomalyDetector:
         Prédit si les samples sont des anomalies
         
         Returns:
-            Dict avec scores et prédictions des deux modèles
+            Dict avec scores et prédictions des deux modèles (ndarrays, voir to_json)
         """
         if not self.is_trained:
             raise ValueError("Models not trained yet")
         
-        X_scaled = self.scaler.transform(X)
+        X_scaled = self._scale(X)
         
-        # Isolation Forest
-        iso_scores = self.isolation_forest.decision_function(X_scaled)
-        iso_preds = self.isolation_forest.predict(X_scaled)
+        # Un seul parcours par modèle : predict() n'est que le signe de decision_function()
+        # (anomalie si score < 0 pour les deux modèles)
+        iso_scores = self._iso_decision(X_scaled)
+        iso_anomaly = iso_scores < 0
         
-        # One-Class SVM
         svm_scores = self.one_class_svm.decision_function(X_scaled)
-        svm_preds = self.one_class_svm.predict(X_scaled)
+        svm_anomaly = svm_scores < 0
         
         # Normaliser scores en [0, 1] (plus haut = plus anormal)
         iso_scores_norm = 1 - (iso_scores - iso_scores.min()) / (iso_scores.max() - iso_scores.min() + 1e-8)
@@ -129,23 +193,23 @@ class AnomalyDetector:
         combined_scores = 0.6 * iso_scores_norm + 0.4 * svm_scores_norm
         
         # Prédiction combinée (anomalie si au moins un modèle détecte)
-        combined_preds = (iso_preds == -1) | (svm_preds == -1)
+        combined_preds = iso_anomaly | svm_anomaly
         
         results = {
             "isolation_forest": {
-                "scores": iso_scores.tolist(),
-                "scores_normalized": iso_scores_norm.tolist(),
-                "predictions": (iso_preds == -1).tolist()
+                "scores": iso_scores,
+                "scores_normalized": iso_scores_norm,
+                "predictions": iso_anomaly
             },
             "one_class_svm": {
-                "scores": svm_scores.tolist(),
-                "scores_normalized": svm_scores_norm.tolist(),
-                "predictions": (svm_preds == -1).tolist()
+                "scores": svm_scores,
+                "scores_normalized": svm_scores_norm,
+                "predictions": svm_anomaly
             },
             "combined": {
-                "scores": combined_scores.tolist(),
-                "predictions": combined_preds.tolist(),
-                "is_anomaly": combined_preds.tolist()
+                "scores": combined_scores,
+                "predictions": combined_preds,
+                "is_anomaly": combined_preds
             }
         }
         
@@ -159,13 +223,14 @@ class AnomalyDetector:
         results = self.predict(x)
         
         # Extraire résultat pour sample unique
+        score = float(results["combined"]["scores"][0])
         return {
-            "anomaly_score": float(results["combined"]["scores"][0]),
+            "anomaly_score": score,
             "is_anomaly": bool(results["combined"]["is_anomaly"][0]),
             "isolation_forest_score": float(results["isolation_forest"]["scores_normalized"][0]),
             "one_class_svm_score": float(results["one_class_svm"]["scores_normalized"][0]),
             "method": "Isolation Forest + One-Class SVM Ensemble",
-            "confidence": "HIGH" if results["combined"]["scores"][0] > 0.8 else ("MEDIUM" if results["combined"]["scores"][0] > 0.5 else "LOW")
+            "confidence": "HIGH" if score > 0.8 else ("MEDIUM" if score > 0.5 else "LOW")
         }
     
     def save(self, filename: str = "anomaly_detector"):
@@ -180,7 +245,7 @@ class AnomalyDetector:
             "one_class_svm": self.one_class_svm,
             "scaler": self.scaler,
             "version": self.version
-        }, model_path)
+        }, model_path, protocol=pickle.HIGHEST_PROTOCOL)
         
         print(f"[ANOMALY] Models saved to {model_path}")
         return model_path
@@ -197,10 +262,13 @@ class AnomalyDetector:
                 raise FileNotFoundError(f"No models found in {MODEL_DIR}")
             model_path = sorted(models)[-1]
         
-        data = joblib.load(model_path)
+        # Non compressé : les ndarrays restent mappés depuis le disque au lieu d'être copiés
+        data = joblib.load(model_path, mmap_mode="r")
         self.isolation_forest = data["isolation_forest"]
         self.one_class_svm = data["one_class_svm"]
         self.scaler = data["scaler"]
+        self._cache_scaler()
+        self._compile_isolation_forest()
         self.version = data["version"]
         self.is_trained = True
         
@@ -212,33 +280,69 @@ class AnomalyDetector:
 # HELPER FUNCTIONS
 # ═══════════════════════════════════════════════════════════════════════════
 
-def load_training_data_from_db(db_pool, limit: int = 10000) -> np.ndarray:
+def to_json(results: Dict) -> Dict:
+    """Convertit les ndarrays de predict() en listes, uniquement à la frontière API"""
+    return {
+        model: {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in values.items()}
+        for model, values in results.items()
+    }
+
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+def decode_float_array_copy(buf: bytes) -> np.ndarray:
+    """
+    Décode un COPY BINARY d'une seule colonne real[] ou float8[] (1 dimension, taille fixe,
+    sans NULL) directement en matrice float32, sans créer un objet Python par valeur
+    """
+    if not buf.startswith(PGCOPY_SIGNATURE):
+        raise ValueError("Not a PostgreSQL binary COPY stream")
+    ext_len = int.from_bytes(buf[15:19], "big")
+    body = memoryview(buf)[19 + ext_len:-2]  # en-tête + extension, trailer int16 -1
+    if not len(body):
+        return None
+    
+    # Lus sur la première ligne : nfields(2) flen(4) ndim(4) hasnull(4) oid(4) dim(4) lbound(4),
+    # puis la taille du premier élément (4 = real, 8 = float8 pour les anciennes tables)
+    n_features = int.from_bytes(body[18:22], "big", signed=True)
+    elem_size = int.from_bytes(body[26:30], "big", signed=True)
+    if elem_size not in (4, 8):
+        raise ValueError("Unexpected feature_vector element type")
+    row = np.dtype([
+        ("nfields", ">i2"), ("flen", ">i4"), ("ndim", ">i4"), ("hasnull", ">i4"),
+        ("oid", ">u4"), ("dim", ">i4"), ("lbound", ">i4"),
+        ("elems", [("len", ">i4"), ("val", f">f{elem_size}")], (n_features,))
+    ])
+    if len(body) % row.itemsize:
+        raise ValueError("Feature vectors have heterogeneous lengths")
+    rows = np.frombuffer(body, dtype=row)
+    if not ((rows["nfields"] == 1).all() and (rows["ndim"] == 1).all()
+            and (rows["hasnull"] == 0).all() and (rows["dim"] == n_features).all()):
+        raise ValueError("Unexpected feature_vector layout")
+    return rows["elems"]["val"].astype(np.float32)
+
+async def load_training_data_from_db(db_pool, limit: int = 10000) -> np.ndarray:
     """
     Charge les features depuis PostgreSQL pour entraînement
     """
-    import asyncio
+    chunks = []
     
-    async def fetch():
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT feature_vector 
-                FROM features 
-                WHERE feature_vector IS NOT NULL
-                ORDER BY computed_at DESC
-                LIMIT $1
-            """, limit)
-            
-            if not rows:
-                return None
-            
-            # Convertir en numpy array
-            vectors = [row['feature_vector'] for row in rows]
-            return np.array(vectors)
+    async def collect(data: bytes):
+        chunks.append(data)
     
-    return asyncio.run(fetch())
+    async with db_pool.acquire() as conn:
+        await conn.copy_from_query("""
+            SELECT feature_vector 
+            FROM features 
+            WHERE feature_vector IS NOT NULL
+              AND array_position(feature_vector, NULL) IS NULL
+            ORDER BY computed_at DESC
+            LIMIT $1
+        """, limit, output=collect, format="binary")
+    
+    return decode_float_array_copy(b"".join(chunks))
 
 
-def auto_retrain_if_needed(
+async def auto_retrain_if_needed(
     detector: AnomalyDetector,
     db_pool,
     min_samples: int = 1000,
@@ -247,44 +351,36 @@ def auto_retrain_if_needed(
     """
     Re-entraîne automatiquement si nécessaire
     """
-    import asyncio
+    # Vérifier nombre de nouveaux samples
+    new_samples_count = await db_pool.fetchval("""
+        SELECT COUNT(*) FROM features 
+        WHERE computed_at > NOW() - make_interval(hours => $1)
+    """, retrain_interval_hours)
     
-    async def check_and_retrain():
-        async with db_pool.acquire() as conn:
-            # Vérifier nombre de nouveaux samples
-            last_retrain = await conn.fetchval("""
-                SELECT MAX(training_duration_seconds) FROM ml_models 
-                WHERE model_type = 'ANOMALY_DETECTION' AND is_active = true
-            """)
-            
-            new_samples_count = await conn.fetchval("""
-                SELECT COUNT(*) FROM features 
-                WHERE computed_at > NOW() - INTERVAL '24 hours'
-            """)
-            
-            if new_samples_count >= min_samples:
-                print(f"[ANOMALY] Auto-retraining with {new_samples_count} new samples")
-                X = load_training_data_from_db(db_pool, limit=10000)
-                if X is not None and len(X) > 100:
-                    metrics = detector.train(X)
-                    detector.save()
-                    
-                    # Enregistrer dans DB
-                    await conn.execute("""
-                        INSERT INTO ml_models (
-                            model_name, model_type, algorithm, version,
-                            training_samples_count, is_active
-                        ) VALUES ($1, $2, $3, $4, $5, true)
-                    """,
-                        "anomaly_detector",
-                        "ANOMALY_DETECTION",
-                        "Isolation Forest + One-Class SVM",
-                        detector.version,
-                        len(X)
-                    )
-                    
-                    return True
-        
+    if new_samples_count < min_samples:
         return False
     
-    return asyncio.run(check_and_retrain())
+    print(f"[ANOMALY] Auto-retraining with {new_samples_count} new samples")
+    X = await load_training_data_from_db(db_pool, limit=10000)
+    if X is None or len(X) <= 100:
+        return False
+    
+    # Entraînement CPU-bound hors de la boucle d'événements
+    await asyncio.to_thread(detector.train, X)
+    await asyncio.to_thread(detector.save)
+    
+    # Enregistrer dans DB
+    await db_pool.execute("""
+        INSERT INTO ml_models (
+            model_name, model_type, algorithm, version,
+            training_samples_count, is_active
+        ) VALUES ($1, $2, $3, $4, $5, true)
+    """,
+        "anomaly_detector",
+        "ANOMALY_DETECTION",
+        "Isolation Forest + One-Class SVM",
+        detector.version,
+        len(X)
+    )
+    
+    return True
@@ -3,17 +3,60 @@ ML Engine — Attack Classification
 Random Forest + Gradient Boosting pour classifier les types d'attaques
 """
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+
+# oneDAL (Intel) pour RandomForest si disponible : doit patcher avant l'import de sklearn.ensemble
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn(["RandomForestClassifier"], verbose=False)
+    SKLEARNEX_AVAILABLE = True
+except ImportError:
+    SKLEARNEX_AVAILABLE = False
+
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
 from sklearn.preprocessing import StandardScaler, LabelEncoder
 from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.metrics import classification_report, accuracy_score, precision_recall_fscore_support
+import asyncio
 import joblib
+from threadpoolctl import threadpool_limits
 import os
-from typing import Dict, List
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
 from datetime import datetime
 
+# Inférence RF + GB compilée en ONNX si disponible, sinon sklearn
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+# Parcours compilé (LLVM) de la forêt pour un sample unique si numba est installé
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 MODEL_DIR = "/app/models"
 
+# Entraînement : un thread par cœur physique (l'hyperthreading n'aide pas le
+# parcours des arbres et se dispute les mêmes unités de calcul)
+TRAIN_N_JOBS = int(os.getenv("CLASSIFIER_TRAIN_JOBS", "0")) or joblib.cpu_count(only_physical_cores=True)
+
+# Micro-batching des prédictions unitaires (BatchedPredictor)
+PREDICT_BATCH_SIZE = int(os.getenv("CLASSIFIER_BATCH_SIZE", "256"))
+PREDICT_BATCH_WAIT = float(os.getenv("CLASSIFIER_BATCH_WAIT_MS", "5")) / 1000
+
+# Cache LRU des prédictions, indexé par le vecteur de features arrondi
+# (beaucoup de requêtes bénignes ont exactement les mêmes features)
+PREDICTION_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", "8192"))
+PREDICTION_CACHE_DECIMALS = 2
+
 # Types d'attaques OWASP
 ATTACK_TYPES = [
     "BENIGN",           # Trafic normal
@@ -28,6 +71,22 @@ ATTACK_TYPES = [
     "UNKNOWN"
 ]
 
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _forest_proba(x, roots, left, right, feature, threshold, value, out):
+        """Moyenne des feuilles atteintes par x dans chaque arbre (nœuds de toutes les forêts concaténés)"""
+        out[:] = 0.0
+        for t in range(roots.shape[0]):
+            node = roots[t]
+            while left[node] != -1:
+                if x[feature[node]] <= threshold[node]:
+                    node = left[node]
+                else:
+                    node = right[node]
+            out += value[node]
+        out /= roots.shape[0]
+
+
 class AttackClassifier:
     """Classificateur de types d'attaques"""
     
@@ -39,6 +98,120 @@ class AttackClassifier:
         self.is_trained = False
         self.version = None
         self.feature_importance = None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._mean = None
+        self._inv_scale = None
+        self._forest = None    # tableaux contigus de la RandomForest pour _forest_proba
+        self._onnx = {}        # nom → graphe ONNX sérialisé
+        self._sessions = {}    # nom → onnxruntime.InferenceSession
+        
+    def _cache_scaler(self):
+        """Copie float32 de mean_ et 1/scale_ pour normaliser sans passer par transform()"""
+        self._mean = self.scaler.mean_.astype(np.float32)
+        self._inv_scale = (1.0 / self.scaler.scale_).astype(np.float32)
+    
+    def _scale(self, X: np.ndarray) -> np.ndarray:
+        """(X - mean) * 1/scale dans un seul buffer float32, sans validation sklearn"""
+        X = np.asarray(X)
+        X_scaled = np.empty(X.shape, dtype=np.float32)
+        np.subtract(X, self._mean, out=X_scaled)
+        np.multiply(X_scaled, self._inv_scale, out=X_scaled)
+        return X_scaled
+    
+    def clear_cache(self):
+        """Vide le cache de prédictions (à appeler à chaque changement de modèle)"""
+        with self._cache_lock:
+            self._cache.clear()
+    
+    def _compile_models(self):
+        """Convertit les arbres RF et GB en graphes ONNX (parcours natif des arbres)"""
+        self._onnx = {}
+        self._sessions = {}
+        if not ONNX_AVAILABLE:
+            return
+        for name, model in (("rf", self.rf_model), ("gb", self.gb_model)):
+            try:
+                onx = convert_sklearn(
+                    model,
+                    initial_types=[("X", FloatTensorType([None, model.n_features_in_]))],
+                    options={id(model): {"zipmap": False}},  # probabilités en tenseur, pas en liste de dicts
+                    target_opset={"": 15, "ai.onnx.ml": 3}
+                )
+                self._onnx[name] = onx.SerializeToString()
+            except Exception as e:
+                print(f"[CLASSIFIER] ONNX conversion unavailable for {name}, using sklearn: {e}")
+        self._open_sessions()
+    
+    def _open_sessions(self):
+        self._sessions = {}
+        if not ONNX_AVAILABLE:
+            return
+        for name, onx in self._onnx.items():
+            self._sessions[name] = ort.InferenceSession(onx, providers=["CPUExecutionProvider"])
+    
+    def _pack_forest(self):
+        """
+        Concatène les arbres de la RandomForest en tableaux contigus (indices de nœuds globaux,
+        feuilles normalisées en probabilités) pour le parcours d'un sample unique
+        """
+        self._forest = None
+        if not NUMBA_AVAILABLE:
+            return
+        try:
+            trees = [est.tree_ for est in self.rf_model.estimators_]
+            offsets = np.cumsum([0] + [t.node_count for t in trees[:-1]])
+            left = np.concatenate([
+                np.where(t.children_left == -1, -1, t.children_left + off) for t, off in zip(trees, offsets)
+            ])
+            right = np.concatenate([
+                np.where(t.children_right == -1, -1, t.children_right + off) for t, off in zip(trees, offsets)
+            ])
+            value = np.concatenate([t.value[:, 0, :] for t in trees])
+            value = value / np.maximum(value.sum(axis=1, keepdims=True), 1e-12)
+            self._forest = (
+                offsets.astype(np.int64),
+                left.astype(np.int64),
+                right.astype(np.int64),
+                np.concatenate([t.feature for t in trees]).astype(np.int64),
+                np.concatenate([t.threshold for t in trees]),
+                np.ascontiguousarray(value),
+            )
+            # Compilation (ou chargement du cache) ici plutôt qu'à la première requête
+            _forest_proba(np.zeros(self.rf_model.n_features_in_, dtype=np.float32), *self._forest,
+                          np.empty(value.shape[1]))
+        except Exception as e:
+            self._forest = None
+            print(f"[CLASSIFIER] Forest packing unavailable, using batch path: {e}")
+    
+    def _predict_proba(self, name: str, model, X_scaled: np.ndarray) -> np.ndarray:
+        session = self._sessions.get(name)
+        if session is not None:
+            # Sorties du convertisseur : (label, probabilities), colonnes = model.classes_
+            _, proba = session.run(None, {"X": X_scaled})
+            return proba
+        return model.predict_proba(X_scaled)
+    
+    @staticmethod
+    def _cache_keys(X: np.ndarray) -> List[bytes]:
+        """Clés de cache : une par ligne, features quantifiées à 2 décimales"""
+        q = np.round(np.asarray(X, dtype=np.float64), PREDICTION_CACHE_DECIMALS)
+        q += 0.0  # normalise -0.0 en 0.0
+        return [row.tobytes() for row in q]
+    
+    def _cache_get(self, key: bytes):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            return entry
+    
+    def _cache_put(self, key: bytes, entry: Dict):
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > PREDICTION_CACHE_SIZE:
+                self._cache.popitem(last=False)
         
     def train(
         self,
@@ -55,7 +228,8 @@ class AttackClassifier:
             X: Features (n_samples, n_features)
             y: Labels (n_samples,) — types d'attaques
         """
-        print(f"[CLASSIFIER] Training on {X.shape[0]} samples")
+        print(f"[CLASSIFIER] Training on {X.shape[0]} samples "
+              f"(RandomForest: {RandomForestClassifier.__module__})")
         
         # Encoder labels
         y_encoded = self.label_encoder.fit_transform(y)
@@ -67,7 +241,8 @@ class AttackClassifier:
         
         # Normaliser
         X_train_scaled = self.scaler.fit_transform(X_train)
-        X_test_scaled = self.scaler.transform(X_test)
+        self._cache_scaler()
+        X_test_scaled = self._scale(X_test)
         
         # 1. Random Forest
         self.rf_model = RandomForestClassifier(
@@ -76,30 +251,45 @@ class AttackClassifier:
             min_samples_split=5,
             min_samples_leaf=2,
             random_state=random_state,
-            n_jobs=-1,
+            n_jobs=TRAIN_N_JOBS,
             class_weight='balanced'  # Important pour classes déséquilibrées
         )
-        self.rf_model.fit(X_train_scaled, y_train)
-        
-        # 2. Gradient Boosting
-        self.gb_model = GradientBoostingClassifier(
-            n_estimators=n_estimators,
+        # Threads (le code des arbres relâche le GIL) : pas de fork ni de copie de X
+        with joblib.parallel_backend("threading", n_jobs=TRAIN_N_JOBS):
+            self.rf_model.fit(X_train_scaled, y_train)
+        
+        # 2. Gradient Boosting sur histogrammes : features binnées en uint8 (255 seuils
+        # par feature), arbres bien plus compacts que GradientBoostingClassifier
+        self.gb_model = HistGradientBoostingClassifier(
+            max_iter=n_estimators,
             max_depth=5,
             learning_rate=0.1,
-            subsample=0.8,
+            max_bins=255,
+            early_stopping=False,
             random_state=random_state
         )
-        self.gb_model.fit(X_train_scaled, y_train)
-        
+        # OpenMP borné aux cœurs physiques, BLAS mono-thread (pas de sursouscription)
+        with threadpool_limits(limits=TRAIN_N_JOBS, user_api="openmp"), \
+                threadpool_limits(limits=1, user_api="blas"):
+            self.gb_model.fit(X_train_scaled, y_train)
+        
+        self._compile_models()
+        self._pack_forest()
+        self.clear_cache()
         self.is_trained = True
         self.version = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         
         # Évaluation
-        rf_pred = self.rf_model.predict(X_test_scaled)
-        gb_pred = self.gb_model.predict(X_test_scaled)
-        
-        # Ensemble (vote majoritaire)
-        ensemble_pred = np.where(rf_pred == gb_pred, rf_pred, rf_pred)  # Priorité RF en cas désaccord
+        # Même chemin d'inférence que predict() (ONNX si compilé), un parcours par modèle
+        rf_proba = self._predict_proba("rf", self.rf_model, X_test_scaled)
+        gb_proba = self._predict_proba("gb", self.gb_model, X_test_scaled)
+        rf_pred = rf_proba.argmax(axis=1)
+        gb_pred = gb_proba.argmax(axis=1)
+        
+        # Ensemble : moyenne des probabilités, comme dans predict()
+        ensemble_proba = np.add(rf_proba, gb_proba)
+        ensemble_proba *= 0.5
+        ensemble_pred = ensemble_proba.argmax(axis=1)
         
         rf_acc = accuracy_score(y_test, rf_pred)
         gb_acc = accuracy_score(y_test, gb_pred)
@@ -110,11 +300,11 @@ class AttackClassifier:
             y_test, ensemble_pred, average='weighted', zero_division=0
         )
         
-        # Feature importance (Random Forest)
-        self.feature_importance = {
-            f"feature_{i}": float(imp) 
-            for i, imp in enumerate(self.rf_model.feature_importances_)
-        }
+        # Feature importance (Random Forest) : ndarray, top 5 par argpartition
+        self.feature_importance = self.rf_model.feature_importances_
+        k = min(5, len(self.feature_importance))
+        top_idx = np.argpartition(self.feature_importance, -k)[-k:]
+        top_idx = top_idx[np.argsort(-self.feature_importance[top_idx])]
         
         metrics = {
             "version": self.version,
@@ -138,11 +328,9 @@ class AttackClassifier:
                 "recall": float(recall),
                 "f1_score": float(f1)
             },
-            "feature_importance_top5": dict(sorted(
-                self.feature_importance.items(),
-                key=lambda x: x[1],
-                reverse=True
-            )[:5])
+            "feature_importance_top5": {
+                f"feature_{i}": float(self.feature_importance[i]) for i in top_idx
+            }
         }
         
         print(f"[CLASSIFIER] Training completed:")
@@ -155,61 +343,107 @@ class AttackClassifier:
         
         return metrics
     
+    def _predict_batch(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Prédit un batch sans cache
+        
+        Returns:
+            pred: indices de classe (n_samples, 3) — colonnes RF, GB, ensemble
+            proba: probabilités float32 (n_samples, 3, n_classes)
+        """
+        X_scaled = self._scale(X)
+        n = X_scaled.shape[0]
+        n_classes = len(self.label_encoder.classes_)
+        
+        proba = np.empty((n, 3, n_classes), dtype=np.float32)
+        if n == 1 and self._forest is not None:
+            # Sample unique : parcours direct des arbres, sans dispatch sklearn/ONNX
+            rf_row = np.empty(n_classes)
+            _forest_proba(X_scaled[0], *self._forest, rf_row)
+            proba[0, 0] = rf_row
+        else:
+            proba[:, 0] = self._predict_proba("rf", self.rf_model, X_scaled)
+        proba[:, 1] = self._predict_proba("gb", self.gb_model, X_scaled)
+        
+        # Ensemble probabilités (moyenne), écrite directement dans sa colonne
+        np.add(proba[:, 0], proba[:, 1], out=proba[:, 2])
+        proba[:, 2] *= 0.5
+        
+        # Prédictions (argmax des probabilités, comme predict() de sklearn)
+        pred = proba.argmax(axis=2)
+        return pred, proba
+    
+    def _predict_cached(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Lecture du cache ligne par ligne, puis un seul appel batch
+        RF + GB sur les lignes manquantes
+        """
+        keys = self._cache_keys(X)
+        entries = [self._cache_get(k) for k in keys]
+        misses = [i for i, entry in enumerate(entries) if entry is None]
+        
+        if len(misses) == len(keys):
+            pred, proba = self._predict_batch(X)
+            for i, key in enumerate(keys):
+                self._cache_put(key, (pred[i].copy(), proba[i].copy()))
+            return pred, proba
+        
+        n_classes = len(self.label_encoder.classes_)
+        pred = np.empty((len(keys), 3), dtype=np.intp)
+        proba = np.empty((len(keys), 3, n_classes), dtype=np.float32)
+        for i, entry in enumerate(entries):
+            if entry is not None:
+                pred[i], proba[i] = entry
+        
+        if misses:
+            miss_pred, miss_proba = self._predict_batch(X[misses])
+            pred[misses] = miss_pred
+            proba[misses] = miss_proba
+            for j, i in enumerate(misses):
+                self._cache_put(keys[i], (miss_pred[j].copy(), miss_proba[j].copy()))
+        
+        return pred, proba
+    
     def predict(self, X: np.ndarray) -> Dict:
-        """Prédit les types d'attaques"""
+        """
+        Prédit les types d'attaques
+        
+        Renvoie des ndarrays (probabilités float32) ; to_json() les convertit
+        à la frontière API
+        """
         if not self.is_trained:
             raise ValueError("Model not trained")
         
-        X_scaled = self.scaler.transform(X)
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
         
-        # Prédictions
-        rf_pred = self.rf_model.predict(X_scaled)
-        gb_pred = self.gb_model.predict(X_scaled)
+        pred, proba = self._predict_cached(X)
         
-        # Probabilités
-        rf_proba = self.rf_model.predict_proba(X_scaled)
-        gb_proba = self.gb_model.predict_proba(X_scaled)
-        
-        # Ensemble probabilités (moyenne)
-        ensemble_proba = (rf_proba + gb_proba) / 2
-        ensemble_pred = ensemble_proba.argmax(axis=1)
-        
-        # Décoder labels
-        rf_labels = self.label_encoder.inverse_transform(rf_pred)
-        gb_labels = self.label_encoder.inverse_transform(gb_pred)
-        ensemble_labels = self.label_encoder.inverse_transform(ensemble_pred)
+        # Décoder labels (indices encodés → classes, sans la validation d'inverse_transform)
+        classes = self.label_encoder.classes_
         
         results = {
             "random_forest": {
-                "predictions": rf_labels.tolist(),
-                "probabilities": rf_proba.tolist()
+                "predictions": classes.take(pred[:, 0]),
+                "probabilities": proba[:, 0]
             },
             "gradient_boosting": {
-                "predictions": gb_labels.tolist(),
-                "probabilities": gb_proba.tolist()
+                "predictions": classes.take(pred[:, 1]),
+                "probabilities": proba[:, 1]
             },
             "ensemble": {
-                "predictions": ensemble_labels.tolist(),
-                "probabilities": ensemble_proba.tolist(),
-                "max_probabilities": ensemble_proba.max(axis=1).tolist()
+                "predictions": classes.take(pred[:, 2]),
+                "probabilities": proba[:, 2],
+                "max_probabilities": proba[:, 2].max(axis=1)
             }
         }
         
         return results
     
-    def predict_single(self, x: np.ndarray) -> Dict:
-        """Prédit pour un seul sample"""
-        if x.ndim == 1:
-            x = x.reshape(1, -1)
-        
-        results = self.predict(x)
-        
-        attack_type = results["ensemble"]["predictions"][0]
-        probability = float(results["ensemble"]["max_probabilities"][0])
-        all_probas = {
-            self.label_encoder.classes_[i]: float(prob)
-            for i, prob in enumerate(results["ensemble"]["probabilities"][0])
-        }
+    def _single_result(self, best: int, ensemble_proba: np.ndarray) -> Dict:
+        probability = float(ensemble_proba[best])
+        all_probas = dict(zip(self.label_encoder.classes_.tolist(), ensemble_proba.tolist()))
         
         # Confiance basée sur probabilité
         if probability >= 0.8:
@@ -220,13 +454,33 @@ class AttackClassifier:
             confidence = "LOW"
         
         return {
-            "attack_type": attack_type,
+            "attack_type": str(self.label_encoder.classes_[best]),
             "probability": probability,
             "confidence": confidence,
             "all_probabilities": all_probas,
             "method": "Random Forest + Gradient Boosting Ensemble"
         }
     
+    def predict_single(self, x: np.ndarray) -> Dict:
+        """Prédit pour un seul sample"""
+        if not self.is_trained:
+            raise ValueError("Model not trained")
+        
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        
+        pred, proba = self._predict_cached(x)
+        return self._single_result(pred[0, 2], proba[0, 2])
+    
+    def predict_many(self, X: np.ndarray) -> List[Dict]:
+        """Un résultat au format predict_single() par ligne, en un seul passage batch"""
+        if not self.is_trained:
+            raise ValueError("Model not trained")
+        
+        pred, proba = self._predict_cached(np.asarray(X))
+        return [self._single_result(pred[i, 2], proba[i, 2]) for i in range(len(pred))]
+    
     def save(self, filename: str = "attack_classifier"):
         """Sauvegarde le modèle"""
         if not self.is_trained:
@@ -241,30 +495,172 @@ class AttackClassifier:
             "label_encoder": self.label_encoder,
             "version": self.version,
             "feature_importance": self.feature_importance
-        }, model_path)
+        }, model_path, protocol=pickle.HIGHEST_PROTOCOL)
+        
+        # Graphes ONNX à côté du pickle : rechargés sans reconversion
+        for name, onx in self._onnx.items():
+            with open(self._onnx_path(model_path, name), "wb") as f:
+                f.write(onx)
+        
+        # Marqueur de la dernière version, écrit en dernier et remplacé atomiquement
+        latest_path = self._latest_path(filename)
+        with open(f"{latest_path}.tmp", "w") as f:
+            f.write(self.version)
+        os.replace(f"{latest_path}.tmp", latest_path)
         
         print(f"[CLASSIFIER] Model saved to {model_path}")
         return model_path
     
     def load(self, filename: str = "attack_classifier", version: str = None):
         """Charge le modèle"""
+        if not version:
+            try:
+                with open(self._latest_path(filename)) as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                pass
+        
         if version:
             model_path = os.path.join(MODEL_DIR, f"{filename}_v{version}.pkl")
         else:
+            # Pas de marqueur (modèles antérieurs) : parcours du répertoire
             import glob
             models = glob.glob(os.path.join(MODEL_DIR, f"{filename}_v*.pkl"))
             if not models:
                 raise FileNotFoundError(f"No models found")
             model_path = sorted(models)[-1]
         
-        data = joblib.load(model_path)
+        # Non compressé : les ndarrays restent mappés depuis le disque au lieu d'être copiés
+        data = joblib.load(model_path, mmap_mode="r")
         self.rf_model = data["rf_model"]
         self.gb_model = data["gb_model"]
         self.scaler = data["scaler"]
+        self._cache_scaler()
         self.label_encoder = data["label_encoder"]
         self.version = data["version"]
         self.feature_importance = data["feature_importance"]
+        if isinstance(self.feature_importance, dict):
+            # Anciens modèles : {"feature_i": importance}, dans l'ordre des features
+            self.feature_importance = np.fromiter(self.feature_importance.values(), dtype=np.float64)
+        
+        onnx_paths = {name: self._onnx_path(model_path, name) for name in ("rf", "gb")}
+        if ONNX_AVAILABLE and all(os.path.exists(p) for p in onnx_paths.values()):
+            self._onnx = {}
+            for name, path in onnx_paths.items():
+                with open(path, "rb") as f:
+                    self._onnx[name] = f.read()
+            self._open_sessions()
+        else:
+            self._compile_models()
+        self._pack_forest()
+        
+        self.clear_cache()
         self.is_trained = True
         
         print(f"[CLASSIFIER] Model loaded from {model_path}")
         return model_path
+    
+    @staticmethod
+    def _latest_path(filename: str) -> str:
+        return os.path.join(MODEL_DIR, f"{filename}_latest")
+    
+    @staticmethod
+    def _onnx_path(model_path: str, name: str) -> str:
+        return f"{os.path.splitext(model_path)[0]}_{name}.onnx"
+
+
+
+class BatchedPredictor:
+    """
+    Regroupe les prédictions unitaires d'un flux de requêtes en batches :
+    un seul appel RF + GB pour jusqu'à PREDICT_BATCH_SIZE vecteurs accumulés
+    pendant au plus PREDICT_BATCH_WAIT secondes
+    """
+    
+    def __init__(self, classifier: AttackClassifier, n_features: int,
+                 max_batch: int = PREDICT_BATCH_SIZE, max_wait: float = PREDICT_BATCH_WAIT):
+        self.classifier = classifier
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._buffer = np.empty((max_batch, n_features), dtype=np.float32)
+        self._queue = asyncio.Queue()
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def predict_single(self, x: np.ndarray) -> Dict:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((x, future))
+        return await future
+    
+    async def _next_batch(self) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        """Attend un premier vecteur, puis complète le batch jusqu'à la taille ou l'échéance"""
+        loop = asyncio.get_running_loop()
+        items = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            try:
+                items.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return items
+    
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            # Vecteur invalide : seule sa requête échoue, la tâche et le reste du batch continuent
+            items = []
+            for x, future in batch:
+                try:
+                    x = np.asarray(x, dtype=np.float32)
+                    if x.shape != self._buffer.shape[1:]:
+                        raise ValueError(f"Expected feature vector of shape {self._buffer.shape[1:]}, got {x.shape}")
+                    self._buffer[len(items)] = x
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                items.append((x, future))
+            n = len(items)
+            if n == 0:
+                continue
+            
+            try:
+                # Hors de la boucle événementielle : le parcours des arbres est CPU-bound
+                results = await asyncio.to_thread(self.classifier.predict_many, self._buffer[:n])
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+def to_json(results: Dict) -> Dict:
+    """Convertit les ndarrays de predict() en listes, uniquement à la frontière API"""
+    return {
+        model: {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in values.items()}
+        for model, values in results.items()
+    }
@@ -0,0 +1,13 @@
+"""
+Précompile la base Hyperscan des motifs OWASP (étape de construction de l'image WAF)
+"""
+import main
+
+if __name__ == "__main__":
+    if not main.HYPERSCAN_AVAILABLE:
+        print("[WAF] Hyperscan not installed, skipping pattern database build")
+    else:
+        db = main.compile_hyperscan_db()
+        with open(main.HS_DB_PATH, "wb") as f:
+            f.write(main.owasp_patterns_digest() + b"\n" + main.hyperscan.dumpb(db))
+        print(f"[WAF] Hyperscan database written to {main.HS_DB_PATH}")
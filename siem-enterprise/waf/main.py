@@ -3,50 +3,103 @@ WAF Intelligent — OWASP Top 10, Rate Limiting, Mode Audit/Block/Strict
 """
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import redis.asyncio as redis
 import httpx
 import time
 import re
-import json
+import orjson
 import asyncio
 from typing import Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 import os
-
-app = FastAPI(title="SIEM WAF", version="2.0.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import hashlib
+
+try:
+    import hyperscan
+    HYPERSCAN_AVAILABLE = True
+except ImportError:
+    HYPERSCAN_AVAILABLE = False
+
+try:
+    import re2
+    RE2_AVAILABLE = True
+except ImportError:
+    RE2_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 INGESTION_API_URL = os.getenv("INGESTION_API_URL", "http://ingestion:8001")
 WAF_MODE = os.getenv("WAF_MODE", "audit")
 RATE_LIMIT_PER_MINUTE = int(os.getenv("MAX_REQUESTS_PER_MINUTE", "100"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONN", "64"))
+# Seuls les premiers octets du corps sont décodés et analysés : travail borné par requête
+MAX_SCAN_BYTES = int(os.getenv("WAF_MAX_SCAN_BYTES", "65536"))
+# Plafonné à la taille de lot acceptée par /api/ingest-batch (INGEST_BATCH_MAX, sinon 413)
+INGESTION_BATCH_MAX = 1000
+INGEST_BATCH_SIZE = min(int(os.getenv("SIEM_BATCH_SIZE", "200")), INGESTION_BATCH_MAX)
+INGEST_FLUSH_SECONDS = float(os.getenv("SIEM_BATCH_MS", "50")) / 1000
 
 redis_client: Optional[redis.Redis] = None
+ip_check_script = None
+ingest_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+ingest_dropped = 0
+# Événements envoyés mais refusés par l'ingestion (statut non 2xx) ou perdus en route
+ingest_failed = 0
+ingest_task: Optional[asyncio.Task] = None
+ingestion_client: Optional[httpx.AsyncClient] = None
+
+# Blocage puis rate limit (INCR + EXPIRE) en un seul aller-retour atomique (EVALSHA,
+# rechargé si NOSCRIPT) ; une IP bloquée n'incrémente pas son compteur
+IP_CHECK_LUA = """
+local b = redis.call('GET', KEYS[1])
+if b then return {b, 0, redis.call('PTTL', KEYS[1])} end
+local c = redis.call('INCR', KEYS[2])
+if c == 1 then redis.call('EXPIRE', KEYS[2], ARGV[1]) end
+return {false, c, 0}
+"""
+
+# IPs bloquées vues récemment : rejetées sans aller-retour Redis pendant quelques secondes
+# (un déblocage fait par une autre instance est donc visible au plus après BLOCK_CACHE_TTL)
+# Index des IPs bloquées (sorted set, score = expiration) : listage et comptage sans KEYS
+BLOCK_INDEX_KEY = "blocked_ip_index"
+
+BLOCK_CACHE_SIZE = 50000
+BLOCK_CACHE_TTL = 5.0
+block_cache: "OrderedDict[str, tuple]" = OrderedDict()
 
 # ── OWASP Patterns ────────────────────────────────────────────────────────────
+# literals : sous-chaînes (minuscules) dont chaque motif de la catégorie exige au moins une
+# Pas de .* ni de [^x]* non bornés : avec re (sans RE2 ni Hyperscan), chaque position de départ
+# pourrait parcourir tout le corps et une requête forgée coûterait un temps quadratique
 OWASP_PATTERNS = {
     "SQL_INJECTION": {
         "code": "A03:2021", "severity": "CRITICAL",
         "patterns": [
-            r"(\bUNION\b.*\bSELECT\b)", r"(\bOR\b\s+\d+\s*=\s*\d+)",
+            r"(\bUNION\b.{0,200}\bSELECT\b)", r"(\bOR\b\s+\d+\s*=\s*\d+)",
             r"(';?\s*DROP\s+TABLE)", r"(1'\s*OR\s*'1'\s*=\s*'1)",
-            r"(\bEXEC\b.*\bxp_cmdshell\b)", r"(\bINSERT\b.*\bINTO\b.*\bVALUES\b)",
-            r"(--\s*$)", r"(/\*.*\*/)", r"(\bSLEEP\s*\(\d+\))",
-        ]
+            r"(\bEXEC\b.{0,200}\bxp_cmdshell\b)", r"(\bINSERT\b[\w\s]{0,30}\bINTO\b.{0,200}\bVALUES\b)",
+            r"(--\s*$)", r"(/\*.{0,200}?\*/)", r"(\bSLEEP\s*\(\d+\))",
+        ],
+        "literals": ["union", "or", "drop", "1'", "xp_cmdshell", "values", "--", "/*", "sleep"]
     },
     "XSS": {
         "code": "A03:2021", "severity": "HIGH",
         "patterns": [
-            r"(<script[^>]*>)", r"(javascript:)", r"(onerror\s*=)",
+            r"(<script[^>]{0,200}>)", r"(javascript:)", r"(onerror\s*=)",
             r"(onload\s*=)", r"(<iframe)", r"(document\.cookie)",
             r"(eval\s*\()", r"(alert\s*\()", r"(String\.fromCharCode)",
+        ],
+        "literals": [
+            "<script", "javascript:", "onerror", "onload", "<iframe", "document.cookie",
+            "eval", "alert", "string.fromcharcode",
         ]
     },
     "PATH_TRAVERSAL": {
@@ -54,155 +107,389 @@ OWASP_PATTERNS = {
         "patterns": [
             r"(\.\./|\.\.\\)", r"(%2e%2e[/%5c])", r"(\.\.%2f)",
             r"(/etc/passwd)", r"(/etc/shadow)", r"(c:\\windows)",
-        ]
+        ],
+        "literals": ["..", "%2e%2e", "/etc/passwd", "/etc/shadow", "c:\\windows"]
     },
     "COMMAND_INJECTION": {
         "code": "A03:2021", "severity": "CRITICAL",
         "patterns": [
-            r"(;\s*cat\s+/etc)", r"(\|\s*ls\s+)", r"(`[^`]+`)",
-            r"(\$\([^)]+\))", r"(&&\s*whoami)", r"(;\s*id\s*;)",
-        ]
+            r"(;\s*cat\s+/etc)", r"(\|\s*ls\s+)", r"(`[^`]{1,200}`)",
+            r"(\$\([^)]{1,200}\))", r"(&&\s*whoami)", r"(;\s*id\s*;)",
+        ],
+        "literals": [";", "|", "`", "$(", "whoami"]
     },
     "XXE": {
         "code": "A05:2021", "severity": "HIGH",
-        "patterns": [r"(<!ENTITY)", r"(<!DOCTYPE.*SYSTEM)", r"(SYSTEM\s+['\"]file)"]
+        "patterns": [r"(<!ENTITY)", r"(<!DOCTYPE.{0,200}SYSTEM)", r"(SYSTEM\s+['\"]file)"],
+        "literals": ["<!entity", "<!doctype", "system"]
     },
     "SSRF": {
         "code": "A10:2021", "severity": "HIGH",
         "patterns": [
             r"(file://)", r"(gopher://)", r"(dict://)",
             r"(localhost|127\.0\.0\.1|0\.0\.0\.0|169\.254\.)",
-        ]
+        ],
+        "literals": ["file://", "gopher://", "dict://", "localhost", "127.0.0.1", "0.0.0.0", "169.254."]
     },
     "SCANNER": {
         "code": "A05:2021", "severity": "MEDIUM",
-        "patterns": [r"(sqlmap)", r"(nikto)", r"(nmap)", r"(masscan)", r"(acunetix)"]
+        "patterns": [r"(sqlmap)", r"(nikto)", r"(nmap)", r"(masscan)", r"(acunetix)"],
+        "literals": ["sqlmap", "nikto", "nmap", "masscan", "acunetix"]
     }
 }
 
+def compile_pattern(pattern: str):
+    """
+    RE2 (automate en temps linéaire, pas de retour arrière : pas de ReDoS sur les `.*`
+    face à un corps contrôlé par l'attaquant) ; re si RE2 absent ou motif refusé
+    """
+    if RE2_AVAILABLE:
+        try:
+            return re2.compile(f"(?i){pattern}")
+        except Exception as e:
+            print(f"[WAF] RE2 rejected pattern, using re: {e}")
+    return re.compile(pattern, re.IGNORECASE)
+
+# Compilation unique au chargement : une alternance par catégorie (une passe au lieu d'une
+# par motif) et une alternance globale à groupes nommés, qui écarte en une seule passe les
+# requêtes sans détection et désigne via lastgroup une catégorie déjà détectée
+for _config in OWASP_PATTERNS.values():
+    _config["source"] = "|".join(f"(?:{p})" for p in _config["patterns"])
+    _config["regex"] = compile_pattern(_config["source"])
+OWASP_MASTER_RE = compile_pattern(
+    "|".join(f"(?P<{attack_type}>{config['source']})" for attack_type, config in OWASP_PATTERNS.items())
+)
+
+# Base Hyperscan : tous les motifs évalués simultanément en une passe SIMD, identifiant =
+# index de la catégorie. Repli sur les alternances re si le module ou la compilation échoue
+OWASP_TYPES = list(OWASP_PATTERNS)
+# Base précompilée à la construction de l'image (build_patterns.py), préfixée de l'empreinte
+# des motifs : une base périmée ou illisible sur ce CPU est recompilée au démarrage
+HS_DB_PATH = os.getenv("WAF_HS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "patterns.hsdb"))
+
+def owasp_patterns_digest() -> bytes:
+    return hashlib.sha256(orjson.dumps([config["patterns"] for config in OWASP_PATTERNS.values()])).hexdigest().encode()
+
+def compile_hyperscan_db():
+    expressions = [
+        (p.encode(), i) for i, config in enumerate(OWASP_PATTERNS.values()) for p in config["patterns"]
+    ]
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[e for e, _ in expressions], ids=[i for _, i in expressions],
+        elements=len(expressions),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(expressions)
+    )
+    return db
+
+def load_hyperscan_db():
+    try:
+        with open(HS_DB_PATH, "rb") as f:
+            digest, _, serialized = f.read().partition(b"\n")
+        if digest == owasp_patterns_digest():
+            db = hyperscan.loadb(serialized, mode=hyperscan.HS_MODE_BLOCK)
+            db.scratch = hyperscan.Scratch(db)
+            db.scan(b"")
+            return db
+        print("[WAF] Hyperscan database outdated, recompiling")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[WAF] Hyperscan database unusable, recompiling: {e}")
+    return compile_hyperscan_db()
+
+hs_db = None
+if HYPERSCAN_AVAILABLE:
+    try:
+        hs_db = load_hyperscan_db()
+    except Exception as e:
+        print(f"[WAF] Hyperscan unavailable, falling back to re: {e}")
+        hs_db = None
+
+# Ressources statiques : segments [\w-] séparés par "/" ou ".", jamais "..", "%" ni ":" ;
+# sans query ni corps, aucun motif OWASP exploitable ne peut y figurer
+STATIC_ASSET_RE = re.compile(r"/(?:(?:static|assets)(?:/[\w-]+(?:\.[\w-]+)*)+|favicon\.ico)")
+
 SUSPICIOUS_USER_AGENTS = [
     "sqlmap", "nikto", "nmap", "masscan", "acunetix", "nessus",
     "openvas", "dirbuster", "gobuster", "hydra", "medusa"
 ]
+SUSPICIOUS_UA_RANK = {sus_ua: i for i, sus_ua in enumerate(SUSPICIOUS_USER_AGENTS)}
+# Repli sans Aho-Corasick : une seule alternance au lieu d'une recherche par User-Agent
+SUSPICIOUS_UA_RE = re.compile("|".join(re.escape(sus_ua) for sus_ua in SUSPICIOUS_USER_AGENTS))
+
+# Automates Aho-Corasick : une passe sur les littéraux de toutes les catégories (seules celles
+# dont un littéral apparaît passent par leur regex) et une passe sur les User-Agents suspects
+owasp_automaton = ua_automaton = None
+if AHOCORASICK_AVAILABLE:
+    _literal_types = {}
+    for attack_type, config in OWASP_PATTERNS.items():
+        for literal in config["literals"]:
+            _literal_types.setdefault(literal, set()).add(attack_type)
+    owasp_automaton = ahocorasick.Automaton()
+    for literal, attack_types in _literal_types.items():
+        owasp_automaton.add_word(literal, frozenset(attack_types))
+    owasp_automaton.make_automaton()
+    ua_automaton = ahocorasick.Automaton()
+    for i, sus_ua in enumerate(SUSPICIOUS_USER_AGENTS):
+        ua_automaton.add_word(sus_ua, (i, sus_ua))
+    ua_automaton.make_automaton()
 
 # ── Startup ────────────────────────────────────────────────────────────────────
-@app.on_event("startup")
-async def startup():
-    global redis_client, WAF_MODE
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global redis_client, ip_check_script, ingest_task, ingestion_client, WAF_MODE
     WAF_MODE = os.getenv("WAF_MODE", "audit")
+    if int(os.getenv("SIEM_BATCH_SIZE", "200")) > INGESTION_BATCH_MAX:
+        print(f"[WAF] SIEM_BATCH_SIZE above ingestion limit, clamped to {INGESTION_BATCH_MAX}")
+    # Client unique, connexions keep-alive vers l'ingestion réutilisées d'un lot à l'autre
+    ingestion_client = httpx.AsyncClient(
+        base_url=INGESTION_API_URL, timeout=3.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    ingest_task = asyncio.create_task(ingest_flush_loop())
     for attempt in range(10):
         try:
-            redis_client = await redis.from_url(REDIS_URL, decode_responses=True)
+            # Pool borné : en pic, on attend une connexion libre (1 s max) plutôt que d'en ouvrir sans limite
+            pool = redis.BlockingConnectionPool.from_url(
+                REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=1,
+                decode_responses=True, socket_keepalive=True, health_check_interval=30
+            )
+            redis_client = redis.Redis(connection_pool=pool)
             await redis_client.ping()
+            ip_check_script = redis_client.register_script(IP_CHECK_LUA)
+            await backfill_block_index()
             print(f"[WAF] Redis connected — Mode: {WAF_MODE}, RateLimit: {RATE_LIMIT_PER_MINUTE}/min")
-            return
+            break
         except Exception as e:
             print(f"[WAF] Redis attempt {attempt+1}/10: {e}")
             await asyncio.sleep(3)
-    print("[WAF] WARNING: Redis not available, continuing without rate limiting")
-
-@app.on_event("shutdown")
-async def shutdown():
+    else:
+        print("[WAF] WARNING: Redis not available, continuing without rate limiting")
+    yield
+
+    if ingest_task:
+        ingest_task.cancel()
+    await flush_pending_ingestion()
+    if ingestion_client:
+        await ingestion_client.aclose()
     if redis_client:
-        await redis_client.close()
+        await redis_client.close(close_connection_pool=True)
 
-# ── Detection Engine ───────────────────────────────────────────────────────────
-async def detect_owasp(request: Request, body: str) -> list:
-    detections = []
-    url = str(request.url)
-    content = f"{url} {request.url.query or ''} {body}".lower()
-    ua = (request.headers.get("User-Agent") or "").lower()
+app = FastAPI(title="SIEM WAF", version="2.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 
-    for attack_type, config in OWASP_PATTERNS.items():
-        for pattern in config["patterns"]:
-            if re.search(pattern, content, re.IGNORECASE):
-                detections.append({
-                    "type": attack_type, "code": config["code"],
-                    "severity": config["severity"], "confidence": 0.9
-                })
-                break
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
-    # Check suspicious UA
-    for sus_ua in SUSPICIOUS_USER_AGENTS:
-        if sus_ua in ua:
+# ── Detection Engine ───────────────────────────────────────────────────────────
+def on_hs_match(id, start, end, flags, matched: set):
+    matched.add(id)
+
+def match_owasp_types(content: str) -> list:
+    """Catégories OWASP détectées dans content, dans l'ordre de OWASP_PATTERNS"""
+    if hs_db is not None:
+        matched = set()
+        hs_db.scan(content.encode(), match_event_handler=on_hs_match, context=matched)
+        return [OWASP_TYPES[i] for i in sorted(matched)]
+    if owasp_automaton is not None:
+        candidates = set()
+        for _, attack_types in owasp_automaton.iter(content.lower()):
+            candidates |= attack_types
+        return [
+            attack_type for attack_type, config in OWASP_PATTERNS.items()
+            if attack_type in candidates and config["regex"].search(content)
+        ]
+    # Une correspondance de l'alternance globale peut en masquer une autre (pas de
+    # chevauchement) : les autres catégories sont vérifiées chacune en une passe
+    first = OWASP_MASTER_RE.search(content)
+    if not first:
+        return []
+    return [
+        attack_type for attack_type, config in OWASP_PATTERNS.items()
+        if attack_type == first.lastgroup or config["regex"].search(content)
+    ]
+
+def suspicious_user_agent(ua: str) -> Optional[str]:
+    """Premier User-Agent suspect (ordre de SUSPICIOUS_USER_AGENTS) contenu dans ua"""
+    if ua_automaton is not None:
+        hits = [hit for _, hit in ua_automaton.iter(ua)]
+        return min(hits)[1] if hits else None
+    return min(SUSPICIOUS_UA_RE.findall(ua), key=SUSPICIOUS_UA_RANK.__getitem__, default=None)
+
+async def detect_owasp(url: str, body: str, user_agent: Optional[str], static_asset: bool = False) -> list:
+    detections = []
+    ua = (user_agent or "").lower()
+
+    # Ressource statique sans charge utile : seul le contrôle du User-Agent s'applique
+    if not static_asset:
+        # url contient déjà la query string ; motifs insensibles à la casse : pas de .lower()
+        # sur tout le contenu (seul le préfiltre Aho-Corasick travaille en minuscules)
+        content = f"{url} {body}"
+        for attack_type in match_owasp_types(content):
+            config = OWASP_PATTERNS[attack_type]
             detections.append({
-                "type": "SCANNER", "code": "A05:2021",
-                "severity": "MEDIUM", "confidence": 0.95, "ua": sus_ua
+                "type": attack_type, "code": config["code"],
+                "severity": config["severity"], "confidence": 0.9
             })
-            break
 
-    return detections
+    # Check suspicious UA
+    sus_ua = suspicious_user_agent(ua)
+    if sus_ua:
+        detections.append({
+            "type": "SCANNER", "code": "A05:2021",
+            "severity": "MEDIUM", "confidence": 0.95, "ua": sus_ua
+        })
 
-async def check_rate_limit(client_ip: str) -> tuple:
-    if not redis_client:
-        return True, 0
-    try:
-        key = f"ratelimit:{client_ip}"
-        current = await redis_client.incr(key)
-        if current == 1:
-            await redis_client.expire(key, 60)
-        return current <= RATE_LIMIT_PER_MINUTE, current
-    except Exception:
-        return True, 0
+    return detections
 
-async def is_ip_blocked(client_ip: str) -> tuple:
+async def backfill_block_index():
+    """Indexe les clés blocked_ip: posées avant l'index (SCAN non bloquant, au démarrage)"""
+    now = time.time()
+    async for key in redis_client.scan_iter(match="blocked_ip:*", count=1000):
+        ttl = await redis_client.ttl(key)
+        if ttl > 0:
+            await redis_client.zadd(BLOCK_INDEX_KEY, {key.removeprefix("blocked_ip:"): now + ttl}, nx=True)
+
+def cache_blocked_ip(client_ip: str, reason: str, ttl_seconds: float):
+    block_cache[client_ip] = (time.monotonic() + min(BLOCK_CACHE_TTL, ttl_seconds), reason)
+    block_cache.move_to_end(client_ip)
+    while len(block_cache) > BLOCK_CACHE_SIZE:
+        block_cache.popitem(last=False)
+
+async def check_ip(client_ip: str) -> tuple:
+    """(bloquée, motif, rate limit respecté, compteur) ; Redis indisponible : requête laissée passer"""
+    entry = block_cache.get(client_ip)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            return True, entry[1], True, 0
+        del block_cache[client_ip]
     if not redis_client:
-        return False, None
+        return False, None, True, 0
     try:
-        key = f"blocked_ip:{client_ip}"
-        reason = await redis_client.get(key)
-        return reason is not None, reason
+        reason, current, pttl = await ip_check_script(
+            keys=[f"blocked_ip:{client_ip}", f"ratelimit:{client_ip}"], args=[60]
+        )
+        if reason is not None:
+            cache_blocked_ip(client_ip, reason, pttl / 1000 if pttl > 0 else BLOCK_CACHE_TTL)
+        return reason is not None, reason, current <= RATE_LIMIT_PER_MINUTE, current
     except Exception:
-        return False, None
+        return False, None, True, 0
 
 async def block_ip(client_ip: str, reason: str, duration_minutes: int = 60):
     if not redis_client:
         return
     try:
         key = f"blocked_ip:{client_ip}"
-        await redis_client.setex(key, duration_minutes * 60, reason)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(key, duration_minutes * 60, reason)
+        pipe.zadd(BLOCK_INDEX_KEY, {client_ip: time.time() + duration_minutes * 60})
+        await pipe.execute()
         print(f"[WAF] Blocked {client_ip} for {duration_minutes}min — {reason}")
     except Exception as e:
         print(f"[WAF] Block error: {e}")
 
-async def send_to_ingestion(data: dict):
+# ── Ingestion Batching ─────────────────────────────────────────────────────────
+def client_ip_of(request: Request) -> str:
+    """Première adresse de X-Forwarded-For ; cas courant (une seule IP) sans split"""
+    xff = request.headers.get("X-Forwarded-For")
+    if not xff:
+        return request.client.host
+    if "," in xff:
+        xff = xff.split(",", 1)[0]
+    return xff.strip()
+
+def send_to_ingestion(data: dict):
+    """
+    Met l'événement en file (put_nowait, aucune tâche créée par requête : ingest_flush_loop
+    est l'unique consommateur) ; file pleine : l'événement le plus ancien est abandonné
+    """
+    global ingest_dropped
+    if ingest_queue.full():
+        ingest_queue.get_nowait()
+        ingest_dropped += 1
+        if ingest_dropped % 1000 == 1:
+            print(f"[WAF] Ingestion queue full — {ingest_dropped} events dropped so far")
+    ingest_queue.put_nowait(data)
+
+async def post_ingestion_batch(batch: list):
+    """Envoie un lot ; un échec n'est jamais bloquant mais est journalisé et compté"""
+    global ingest_failed
     try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            await client.post(f"{INGESTION_API_URL}/api/ingest", json=data)
-    except Exception:
-        pass  # Don't block on ingestion failure
+        resp = await ingestion_client.post(
+            "/api/ingest-batch", content=orjson.dumps(batch), headers={"Content-Type": "application/json"}
+        )
+        if resp.is_success:
+            return
+        error = f"HTTP {resp.status_code}: {resp.text[:200]}"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    ingest_failed += len(batch)
+    print(f"[WAF] Ingestion batch of {len(batch)} events failed ({ingest_failed} lost so far): {error}")
+
+async def ingest_flush_loop():
+    """Envoie la file par lots : SIEM_BATCH_SIZE événements ou SIEM_BATCH_MS, le premier atteint"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await ingest_queue.get()]
+        deadline = loop.time() + INGEST_FLUSH_SECONDS
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(ingest_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        await post_ingestion_batch(batch)
+
+async def flush_pending_ingestion():
+    batch = []
+    while not ingest_queue.empty():
+        batch.append(ingest_queue.get_nowait())
+    for i in range(0, len(batch), INGEST_BATCH_SIZE):
+        await post_ingestion_batch(batch[i:i + INGEST_BATCH_SIZE])
 
 # ── Main Middleware ────────────────────────────────────────────────────────────
 @app.middleware("http")
 async def waf_middleware(request: Request, call_next):
     # Skip health endpoint
-    if request.url.path == "/health":
+    path = request.url.path
+    if path == "/health":
         return await call_next(request)
 
     start_time = time.time()
-    client_ip = request.headers.get("X-Forwarded-For", request.client.host).split(",")[0].strip()
+    ts = datetime.utcnow()  # sérialisé en ISO 8601 par orjson
+    url = str(request.url)
+    user_agent = request.headers.get("User-Agent")
+    query = request.url.query
+    client_ip = client_ip_of(request)
 
-    # 1. Check blocked IP
-    blocked, block_reason = await is_ip_blocked(client_ip)
+    # 1. Check blocked IP (+ rate limit, même aller-retour Redis)
+    blocked, block_reason, rate_ok, count = await check_ip(client_ip)
     if blocked:
-        asyncio.create_task(send_to_ingestion({
-            "timestamp": datetime.utcnow().isoformat(), "client_ip": client_ip,
-            "method": request.method, "url": str(request.url),
+        send_to_ingestion({
+            "timestamp": ts, "client_ip": client_ip,
+            "method": request.method, "url": url,
             "is_blocked": True, "block_reason": block_reason,
             "waf_rules_triggered": ["IP_BLOCKED"], "owasp_detections": []
-        }))
-        return JSONResponse(status_code=403, content={"error": "Access Denied", "reason": "IP blocked"})
+        })
+        return ORJSONResponse(status_code=403, content={"error": "Access Denied", "reason": "IP blocked"})
 
     # 2. Rate limit
-    rate_ok, count = await check_rate_limit(client_ip)
     if not rate_ok and WAF_MODE in ("block", "strict"):
         await block_ip(client_ip, "Rate limit exceeded", 15)
-        return JSONResponse(status_code=429, content={"error": "Too Many Requests"})
+        return ORJSONResponse(status_code=429, content={"error": "Too Many Requests"})
 
     # 3. Read body & detect
     body_bytes = await request.body()
-    body = body_bytes.decode("utf-8", errors="ignore")
-    detections = await detect_owasp(request, body)
+    body_truncated = len(body_bytes) > MAX_SCAN_BYTES
+    body = body_bytes[:MAX_SCAN_BYTES].decode("utf-8", errors="ignore")
+    static_asset = not body_bytes and not query and STATIC_ASSET_RE.fullmatch(path)
+    detections = await detect_owasp(url, body, user_agent, static_asset=bool(static_asset))
     is_suspicious = len(detections) > 0
     waf_rules = [d["type"] for d in detections]
     is_blocked_now = False
@@ -215,29 +502,30 @@ async def waf_middleware(request: Request, call_next):
             await block_ip(client_ip, f"OWASP: {waf_rules[0]}", 120)
 
     if is_blocked_now:
-        asyncio.create_task(send_to_ingestion({
-            "timestamp": datetime.utcnow().isoformat(), "client_ip": client_ip,
-            "method": request.method, "url": str(request.url),
-            "user_agent": request.headers.get("User-Agent"),
-            "body": body[:500], "is_blocked": True, "is_suspicious": True,
+        send_to_ingestion({
+            "timestamp": ts, "client_ip": client_ip,
+            "method": request.method, "url": url,
+            "user_agent": user_agent,
+            "body": body[:500], "body_truncated": body_truncated,
+            "is_blocked": True, "is_suspicious": True,
             "waf_rules_triggered": waf_rules, "owasp_detections": detections
-        }))
-        return JSONResponse(status_code=403, content={"error": "Request Blocked", "rules": waf_rules})
+        })
+        return ORJSONResponse(status_code=403, content={"error": "Request Blocked", "rules": waf_rules})
 
     # 5. Let through
     response = await call_next(request)
     response_time = (time.time() - start_time) * 1000
 
-    asyncio.create_task(send_to_ingestion({
-        "timestamp": datetime.utcnow().isoformat(), "client_ip": client_ip,
-        "method": request.method, "url": str(request.url),
-        "path": request.url.path, "query_string": request.url.query,
-        "user_agent": request.headers.get("User-Agent"),
-        "body": body[:500], "status_code": response.status_code,
+    send_to_ingestion({
+        "timestamp": ts, "client_ip": client_ip,
+        "method": request.method, "url": url,
+        "path": path, "query_string": query,
+        "user_agent": user_agent,
+        "body": body[:500], "body_truncated": body_truncated, "status_code": response.status_code,
         "response_time_ms": response_time,
         "is_blocked": False, "is_suspicious": is_suspicious,
         "waf_rules_triggered": waf_rules, "owasp_detections": detections
-    }))
+    })
 
     return response
 
@@ -253,21 +541,36 @@ async def admin_block_ip(ip: str, reason: str = "Manual block", duration_minutes
 
 @app.post("/admin/unblock-ip")
 async def admin_unblock_ip(ip: str):
+    block_cache.pop(ip, None)
     if redis_client:
-        await redis_client.delete(f"blocked_ip:{ip}")
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(f"blocked_ip:{ip}")
+        pipe.zrem(BLOCK_INDEX_KEY, ip)
+        await pipe.execute()
     return {"success": True, "ip": ip}
 
 @app.get("/admin/blocked-ips")
 async def admin_blocked_ips():
     if not redis_client:
         return {"blocked_ips": [], "total": 0}
-    keys = await redis_client.keys("blocked_ip:*")
-    blocked = []
-    for key in keys:
-        ip_addr = key.replace("blocked_ip:", "")
-        reason = await redis_client.get(key)
-        ttl = await redis_client.ttl(key)
-        blocked.append({"ip": ip_addr, "reason": reason, "expires_in_seconds": ttl})
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zremrangebyscore(BLOCK_INDEX_KEY, "-inf", now)
+    pipe.zrangebyscore(BLOCK_INDEX_KEY, now, "+inf", withscores=True)
+    _, entries = await pipe.execute()
+    # Motifs lus en un seul aller-retour ; l'échéance vient du score, pas de TTL par IP
+    pipe = redis_client.pipeline(transaction=False)
+    for ip_addr, _ in entries:
+        pipe.get(f"blocked_ip:{ip_addr}")
+    reasons = await pipe.execute() if entries else []
+    blocked, stale = [], []
+    for (ip_addr, expires_at), reason in zip(entries, reasons):
+        if reason is None:
+            stale.append(ip_addr)  # clé supprimée hors du WAF (rollback SOAR direct)
+            continue
+        blocked.append({"ip": ip_addr, "reason": reason, "expires_in_seconds": int(expires_at - now)})
+    if stale:
+        await redis_client.zrem(BLOCK_INDEX_KEY, *stale)
     return {"blocked_ips": blocked, "total": len(blocked)}
 
 @app.post("/admin/change-mode")
@@ -282,11 +585,14 @@ async def change_mode(mode: str):
 async def admin_stats():
     if not redis_client:
         return {"error": "Redis not available"}
-    blocked_keys = await redis_client.keys("blocked_ip:*")
+    blocked_count = await redis_client.zcount(BLOCK_INDEX_KEY, time.time(), "+inf")
     return {
         "mode": WAF_MODE,
         "rate_limit_per_minute": RATE_LIMIT_PER_MINUTE,
-        "blocked_ips_count": len(blocked_keys)
+        "blocked_ips_count": blocked_count,
+        "ingest_queue_size": ingest_queue.qsize(),
+        "ingest_dropped": ingest_dropped,
+        "ingest_failed": ingest_failed
     }
 
 if __name__ == "__main__":